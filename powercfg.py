@@ -1,5 +1,6 @@
 import subprocess
-import chardet
+import ctypes
+import locale
 import re
 from abc import ABC, abstractmethod
 import json
@@ -9,21 +10,27 @@ import os.path
 class WrongSettingValueException(Exception): ...
 
 class Node(ABC):
-    _GUID_PATTERN = r'\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b'
-    _NAME_PATTERN = r'\(([^)]+)\)'
-    _SPACE_2_PATTERN = r'^ {2}[^ ]'
-    _SPACE_4_PATTERN = r'^ {4}[^ ]'
-    _SPACE_6_PATTERN = r'^ {6}[^ ]'
+    _GUID_RE = re.compile(r'\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b')
+    _NAME_RE = re.compile(r'\(([^)]+)\)')
 
     _guid : str = None
     _name : str = None
 
-    def __init__(self, str_to_parse:str) -> None:
+    def __init__(self, header:str) -> None:
         super().__init__()
-        self.__start_parse(str_to_parse)
+        # nodes are built from their header row only, full output goes through Scheme.from_output
+        if '\n' in header:
+            raise ValueError('Node expects a single header row, use Scheme.from_output to parse powercfg output')
 
+        # find GUID and name in the header row
+        self._guid = self._find_str(header, self._GUID_RE)
+        self._name = self._find_str(header, self._NAME_RE)
+        if self._name != None:
+            self._name = self._name[1:-1]
+
+    # handles a row of the node body; returns the child node started by the row, if any
     @abstractmethod
-    def _parse(self, rows:list[str]):
+    def _feed_line(self, line:str, indent:int) -> 'Node':
         pass
 
     @abstractmethod
@@ -34,29 +41,12 @@ class Node(ABC):
     def to_json(self) -> Any:
         pass
 
-    def __start_parse(self, str_to_parse:str):
-        rows = str_to_parse.split('\n')
-
-        # find GUID and name in the first row
-        self._guid = self._find_str(rows[0], self._GUID_PATTERN)
-        self._name = self._find_str(rows[0], self._NAME_PATTERN)
-        if self._name != None:
-            self._name = self._name[1:-1]
-
-        self._parse(rows[1:])
-
-    def _find_str(self, string:str, pattern:str) -> str:
-        match = re.search(pattern, string)
+    def _find_str(self, string:str, pattern:re.Pattern) -> str:
+        match = pattern.search(string)
         if match:
             return match.group(0)
         return None
     
-    def _find_index(self, string:str, pattern:str) -> int:
-        match = re.search(pattern, string)
-        if match:
-            return match.span(0)
-        return -1
-
     def get_guid(self) -> str:
         return self._guid
     
@@ -67,66 +57,73 @@ class Setting(Node):
     RANGE_OPTIONS : int = 0
     LIST_OPTIONS : int = 1
 
-    __doc : list[dict] = None
+    # doc rows are kept as parallel columns, hex values are stored in decimal
+    __doc_descriptions : list[str] = None
+    __doc_values : list[str] = None
 
     __ac_value : int = None
     __old_ac_value : int = None
+    __ac_hex : str = None
 
     __dc_value : int = None
     __old_dc_value : int = None
+    __dc_hex : str = None
 
     __options_type : int = None
     __options : list[int] = None
+
+    # exported JSON, rebuilt only after a value change
+    __doc_json : tuple[dict] = None
+    __json_cache : dict = None
     
-    def __init__(self, str_to_parse: str) -> None:
-        super().__init__(str_to_parse)
-        self.__parse_options()
+    def __init__(self, header: str) -> None:
+        super().__init__(header)
+        self.__doc_descriptions = []
+        self.__doc_values = []
 
-    def __value_parse(self, value:str) -> str:
-        if value.startswith('0x'):
-            return str(int(value, 16))
-        else:
-            return value
-        
     def __parse_options(self) -> None:
-        val_1:str = self.__doc[0]['value']
-        val_2:str = self.__doc[1]['value']
+        if len(self.__doc_values) < 2:
+            m = f'Setting: {self.get_name()}; GUID: {self.get_guid()}; expected at least 2 doc rows, got {len(self.__doc_values)}'
+            raise ValueError(m)
+        val_1, val_2 = self.__doc_values[:2]
 
         if val_1.isdigit() and val_2.isdigit():
             self.__options_type = Setting.RANGE_OPTIONS
             self.__options = [int(val_1), int(val_2)]
         else:
             self.__options_type = Setting.LIST_OPTIONS
-            self.__options = []
-            for item in self.__doc:
-                if item['value'].isdigit():
-                    self.__options.append(int(item['value']))
+            self.__options = [int(value) for value in self.__doc_values if value.isdigit()]
 
     def __check_value(self, value:int) -> bool:
-        if self.__options_type == Setting.RANGE_OPTIONS:
-            return value >= self.__options[0] and value <= self.__options[1]
+        options = self.get_options()
+        if self.get_options_type() == Setting.RANGE_OPTIONS:
+            return value >= options[0] and value <= options[1]
         else:
-            return value in self.__options
+            return value in options
     
-    def _parse(self, rows:list[str]):
-        self.__doc = []
-        for i in range(len(rows)):
-            # if row contains doc
-            if self._find_index(rows[i], self._SPACE_6_PATTERN) != -1 and rows[i].find('GUID') == -1:
-                spt = rows[i].strip().split(':')
-                self.__doc.append({
-                    'description': spt[0],
-                    'value': self.__value_parse(spt[1].strip())
-                })
-            # if row contains AC/DC value
-            elif self._find_index(rows[i], self._SPACE_4_PATTERN) != -1:
-                value = int(rows[i].split(':')[1].strip(), 16)
-                if self.__ac_value == None:
-                    self.__ac_value = value
-                    self.__old_ac_value = value
-                else:
-                    self.__dc_value = value
-                    self.__old_dc_value = value
+    def _feed_line(self, line:str, indent:int) -> Node:
+        # if row contains doc
+        if indent == 6 and 'GUID' not in line:
+            description, _, value = line.strip().partition(':')
+            self.__doc_descriptions.append(description)
+            value = value.strip()
+            if value.startswith('0x'):
+                value = str(int(value, 16))
+            self.__doc_values.append(value)
+        # if row contains AC/DC value
+        elif indent == 4:
+            value = int(line.partition(':')[2].strip(), 16)
+            if self.__ac_value == None:
+                self.__ac_value = value
+                self.__old_ac_value = value
+            else:
+                self.__dc_value = value
+                self.__old_dc_value = value
+        return None
+
+    def _end_parse(self) -> None:
+        # called once all rows of the setting are fed
+        self.__parse_options()
 
     def load_from_json(self, json_data: dict):
         self.set_ac_value(json_data['ac_value'])
@@ -136,16 +133,27 @@ class Setting(Node):
         return self.__ac_value
 
     def get_ac_value_hex(self) -> str:
-        return hex(self.__ac_value)
+        if self.__ac_hex == None:
+            self.__ac_hex = hex(self.__ac_value)
+        return self.__ac_hex
     
     def get_dc_value(self) -> int:
         return self.__dc_value
     
     def get_dc_value_hex(self) -> str:
-        return hex(self.__dc_value)
+        if self.__dc_hex == None:
+            self.__dc_hex = hex(self.__dc_value)
+        return self.__dc_hex
     
     def get_doc(self) -> list[dict]:
-        return self.__doc
+        # doc never changes after parsing
+        if self.__doc_json == None:
+            self.__doc_json = tuple(
+                {'description': description, 'value': value}
+                for description, value in zip(self.__doc_descriptions, self.__doc_values)
+            )
+        # callers get copies so the cached entries can't be modified
+        return [dict(entry) for entry in self.__doc_json]
     
     def get_options_type(self) -> int:
         return self.__options_type
@@ -163,8 +171,11 @@ class Setting(Node):
         if self.__check_value(value):
             if is_ac:
                 self.__ac_value = value
+                self.__ac_hex = None
             else:
                 self.__dc_value = value
+                self.__dc_hex = None
+            self.__json_cache = None
         else:
             m = f'Setting: {self.get_name()}; GUID: {self.get_guid()}; value to set: {value}; available options: {self.get_options()}; options type: {self.get_options_type_str()}'
             raise WrongSettingValueException(m)
@@ -186,128 +197,150 @@ class Setting(Node):
         self.__old_dc_value = self.__dc_value
 
     def to_json(self) -> Any:
-        return {
-            'name': self.get_name(),
-            'options_type': self.get_options_type(),
-            'options': self.get_options(),
-            'ac_value': self.get_ac_value(),
-            'dc_value': self.get_dc_value(),
-            'doc': self.get_doc()
-        }
+        if self.__json_cache == None:
+            self.__json_cache = {
+                'name': self.get_name(),
+                'options_type': self.get_options_type(),
+                'options': self.get_options(),
+                'ac_value': self.get_ac_value(),
+                'dc_value': self.get_dc_value(),
+                'doc': self.get_doc()
+            }
+        # shallow copy with own mutable parts keeps the cache private
+        return {**self.__json_cache, 'options': list(self.get_options()), 'doc': self.get_doc()}
 
 class SubGroup(Node):
     __settings : list[Setting] = None
+    __settings_index : dict[str, Setting] = None
 
-    def __init__(self, str_to_parse: str) -> None:
-        super().__init__(str_to_parse)
-
-    def _parse(self, rows:list[str]):
+    def __init__(self, header: str) -> None:
+        super().__init__(header)
         self.__settings = []
-        # find settings
-        start_ind, end_ind = -1, -1
-        for i in range(len(rows)):
-            IS_LAST_ROW = i == (len(rows) - 1)
-            HAS_GUID = self._find_index(rows[i], self._SPACE_4_PATTERN) != -1 and self._find_index(rows[i], self._GUID_PATTERN) != -1
-
-            if HAS_GUID and start_ind == -1:
-                start_ind = i
-            elif start_ind != -1 and HAS_GUID:
-                end_ind = i
-            elif start_ind != -1 and IS_LAST_ROW:
-                end_ind = len(rows)
-
-            if end_ind != -1:
-                block = '\n'.join(rows[start_ind:end_ind])
-                self.__settings.append(Setting(block))
-                start_ind, end_ind = i, -1
+        self.__settings_index = {}
+
+    def _feed_line(self, line:str, indent:int) -> Node:
+        # if row starts a new setting
+        if indent == 4 and self._find_str(line, self._GUID_RE) != None:
+            setting = Setting(line)
+            self.__settings.append(setting)
+            self.__settings_index[setting.get_guid()] = setting
+            return setting
+        return None
 
     def load_from_json(self, json_data: dict):
-        try:
-            for setting in self.get_settings():
-                setting.load_from_json(json_data['settings'][setting.get_guid()])
-        except KeyError:
-            pass
+        # settings missing in json or in the subgroup are skipped
+        index = self.__settings_index
+        for guid, setting_data in json_data.get('settings', {}).items():
+            if guid in index:
+                index[guid].load_from_json(setting_data)
 
     def get_settings(self) -> list[Setting]:
         return self.__settings
     
     def to_json(self) -> Any:
-        settings_dict = {}
-        for setting in self.get_settings():
-            settings_dict[setting.get_guid()] = setting.to_json()
-
         return {
             'name': self.get_name(),
-            'settings': settings_dict
+            'settings': {setting.get_guid(): setting.to_json() for setting in self.get_settings()}
         }
 
 class Scheme(Node):
     __subgroups : list[SubGroup] = None
+    __subgroups_index : dict[str, SubGroup] = None
 
-    def __init__(self, str_to_parse: str) -> None:
-        super().__init__(str_to_parse)
-
-    def _parse(self, rows:list[str]):
+    def __init__(self, header: str) -> None:
+        super().__init__(header)
         self.__subgroups = []
-        # find subgroups
-        start_ind, end_ind = -1, -1
-        for i in range(len(rows)):
-            IS_LAST_ROW = i == (len(rows) - 1)
-            HAS_GUID = self._find_index(rows[i], self._SPACE_2_PATTERN) != -1 and self._find_index(rows[i], self._GUID_PATTERN) != -1
-
-            if HAS_GUID and start_ind == -1:
-                start_ind = i
-            elif start_ind != -1 and HAS_GUID:
-                end_ind = i
-            elif start_ind != -1 and IS_LAST_ROW:
-                end_ind = len(rows)
-
-            if end_ind != -1:
-                block = '\n'.join(rows[start_ind:end_ind])
-                self.__subgroups.append(SubGroup(block))
-                start_ind, end_ind = i, -1
+        self.__subgroups_index = {}
+
+    def _feed_line(self, line:str, indent:int) -> Node:
+        # if row starts a new subgroup
+        if indent == 2 and self._find_str(line, self._GUID_RE) != None:
+            subgroup = SubGroup(line)
+            self.__subgroups.append(subgroup)
+            self.__subgroups_index[subgroup.get_guid()] = subgroup
+            return subgroup
+        return None
+
+    @classmethod
+    def from_output(cls, text:str) -> 'Scheme':
+        rows = iter(text.splitlines())
+        # the first non-empty row is the scheme header, empty output gives an empty scheme
+        header = next((row.lstrip(' ') for row in rows if row.strip(' ')), '')
+        scheme = cls(header)
+
+        # bound feed methods of the current nodes are kept as locals for the hot loop
+        feed_scheme = scheme._feed_line
+        feed_subgroup, feed_setting = None, None
+        setting = None
+        # every row is visited once and handed to the innermost node it belongs to
+        for row in rows:
+            line = row.lstrip(' ')
+            if not line:
+                continue
+            indent = len(row) - len(line)
+
+            if indent == 2:
+                child = feed_scheme(line, indent)
+                if child != None:
+                    if setting != None:
+                        setting._end_parse()
+                    feed_subgroup, feed_setting, setting = child._feed_line, None, None
+            elif feed_subgroup != None:
+                child = feed_subgroup(line, indent)
+                if child != None:
+                    if setting != None:
+                        setting._end_parse()
+                    feed_setting, setting = child._feed_line, child
+                elif feed_setting != None:
+                    feed_setting(line, indent)
+
+        if setting != None:
+            setting._end_parse()
+        return scheme
 
     def load_from_json(self, json_data: dict):
         if json_data['guid'] != self.get_guid():
             raise Exception("Wrong guid for schema")
-        
-        for subgroup in self.get_subgroups():
-            try:
-                subgroup.load_from_json(json_data['subgroups'][subgroup.get_guid()])
-            except KeyError:
-                pass
+
+        # subgroups missing in json or in the scheme are skipped
+        index = self.__subgroups_index
+        for guid, subgroup_data in json_data.get('subgroups', {}).items():
+            if guid in index:
+                index[guid].load_from_json(subgroup_data)
 
     def get_subgroups(self) -> list[SubGroup]:
         return self.__subgroups
     
     def to_json(self) -> Any:
-        subgroups_dict = {}
-        for subgroup in self.get_subgroups():
-            subgroups_dict[subgroup.get_guid()] = subgroup.to_json()
-
         return {
             'guid': self.get_guid(),
             'name': self.get_name(),
-            'subgroups': subgroups_dict
+            'subgroups': {subgroup.get_guid(): subgroup.to_json() for subgroup in self.get_subgroups()}
         }
 
 class PowerCfg:
-    __GET_CUR_CFG : str = 'powercfg /query'
+    __GET_CUR_CFG : list[str] = ['powercfg', '/query']
 
     __scheme : Scheme = None
 
     def __init__(self) -> None:
-        self.__scheme = Scheme(PowerCfg.__call_shell(PowerCfg.__GET_CUR_CFG))
+        self.__scheme = Scheme.from_output(PowerCfg.__call_shell(PowerCfg.__GET_CUR_CFG))
 
     @staticmethod
-    def __decode(bytes_obj:bytes) -> str:
-        encoding = chardet.detect(bytes_obj)['encoding']
-        return bytes_obj.decode(encoding)
+    def __get_console_encoding() -> str:
+        # console tools write their output in the OEM code page
+        try:
+            return f'cp{ctypes.windll.kernel32.GetOEMCP()}'
+        except AttributeError:
+            return locale.getpreferredencoding(False)
 
     @staticmethod
-    def __call_shell(command:str) -> str:
-        process = subprocess.run(command, stdout=subprocess.PIPE, shell=True)
-        return PowerCfg.__decode(process.stdout)
+    def __call_shell(command:list[str]) -> str:
+        process = subprocess.run(
+            command, stdout=subprocess.PIPE, check=True,
+            text=True, encoding=PowerCfg.__get_console_encoding(), errors='replace'
+        )
+        return process.stdout
     
     def get_scheme(self) -> Scheme:
         return self.__scheme
@@ -325,11 +358,11 @@ class PowerCfg:
         for subgroup in self.get_scheme().get_subgroups():
             for setting in subgroup.get_settings():
                 if setting.is_ac_changed():
-                    command = f'powercfg -setacvalueindex {self.get_scheme().get_guid()} {subgroup.get_guid()} {setting.get_guid()} {setting.get_ac_value_hex()}'
+                    command = ['powercfg', '-setacvalueindex', self.get_scheme().get_guid(), subgroup.get_guid(), setting.get_guid(), setting.get_ac_value_hex()]
                     subprocess.run(command)
-                    print(command)
+                    print(' '.join(command))
                 if setting.is_dc_changed():
-                    command = f'powercfg -setdcvalueindex {self.get_scheme().get_guid()} {subgroup.get_guid()} {setting.get_guid()} {setting.get_dc_value_hex()}'
+                    command = ['powercfg', '-setdcvalueindex', self.get_scheme().get_guid(), subgroup.get_guid(), setting.get_guid(), setting.get_dc_value_hex()]
                     subprocess.run(command)
-                    print(command)
+                    print(' '.join(command))
                 setting.update_old_values()
\ No newline at end of file